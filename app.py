@@ -1,21 +1,59 @@
+import os
+import logging
+import threading
 import streamlit as st
 import fastf1 as ff1
 import pandas as pd
-from sklearn.linear_model import LinearRegression 
 import numpy as np 
-import re 
-from typing import List, Any 
-from fastf1.core import SessionResults, Lap # Lap型をインポート
-import plotly.express as px
+from typing import List
 
 # --- ページ設定 ---
 st.set_page_config(layout="wide")
+# Copy-on-Write: 派生 DataFrame は書き込み時にのみコピーされる
+# (pandas 3.x では常に有効で、このオプションは非推奨 / 4.0 で削除予定のため 2.x 以前でのみ設定)
+if int(pd.__version__.split('.')[0]) < 3:
+    pd.set_option('mode.copy_on_write', True)
+logger = logging.getLogger(__name__)
+
+# --- FastF1 のディスクキャッシュ (再起動後もダウンロード済みデータを再利用) ---
+# FastF1 3.x は既定でも OS のキャッシュディレクトリにキャッシュするが、アプリ直下の ./cache に置く
+# enable_cache は呼ぶたびに HTTP セッション (SQLite) を作り直すため、cache_resource でプロセスごとに1回だけ実行
+# FASTF1_CACHE は FastF1 自身の環境変数。enable_cache にパスを明示すると FastF1 はこれを参照しないため、ここで尊重する
+FASTF1_CACHE_DIR = os.environ.get('FASTF1_CACHE', './cache')
+
+@st.cache_resource(show_spinner=False)
+def enable_fastf1_cache(cache_dir):
+    os.makedirs(cache_dir, exist_ok=True)
+    ff1.Cache.enable_cache(cache_dir)
+    return cache_dir
+
+enable_fastf1_cache(FASTF1_CACHE_DIR)
+
+# --- キャッシュ件数の上限 (長時間稼働時のメモリ増加を防ぐ。古いものから破棄) ---
+SCHEDULE_CACHE_MAX_ENTRIES = 16     # 年 x 数件分のスケジュール/セッション一覧
+SESSION_CACHE_MAX_ENTRIES = 8       # laps を丸ごと持つキャッシュ
+SESSION_OBJ_CACHE_MAX_ENTRIES = 4   # FastF1 Session 本体 (最も重い)
+DRIVER_CACHE_MAX_ENTRIES = 64       # ドライバー (組) 単位の小さなフレーム/図
+
+# --- session.load の引数 ---
+# テレメトリ (車載データ) と天候は未使用のため読み込まない。
+# レースコントロールメッセージは削除ラップの判定 (IsPersonalBest / pick_fastest) に使われるため残す
+SESSION_LOAD_KWARGS = dict(laps=True, telemetry=False, weather=False, messages=True)
 
 # --- タイヤ色の定義 (最終決定版) ---
 TYRE_COLORS = {
     'SOFT': '#dc143c', 'MEDIUM': '#ffd700', 'HARD': '#66d6fb',
     'INTERMEDIATE': '#4CAF50', 'WET': '#0D47A1'
 }
+COMPOUND_ORDER = ('SOFT', 'MEDIUM', 'HARD', 'INTERMEDIATE', 'WET')
+COMPOUND_DTYPE = pd.CategoricalDtype(categories=COMPOUND_ORDER, ordered=True)
+
+# --- セッションの並び順 ---
+SESSION_KEYS = ('Session1', 'Session2', 'Session3', 'Session4', 'Session5')
+SESSION_ORDER = (
+    'Practice 1', 'FP1', 'Practice 2', 'FP2', 'Practice 3', 'FP3', 'Sprint Shootout', 'SQ', 'Sprint Qualifying',
+    'Qualifying', 'Q', 'Sprint', 'S', 'Race', 'R'
+)
 
 # --- アプリのタイトル ---
 st.title("F1 Data Analysis Dashboard 🏎️")
@@ -25,122 +63,338 @@ st.sidebar.header("Filter Options ⚙️")
 
 # (年の選択)
 supported_years = [2024, 2023, 2022]
+
+# (既定のレース/セッション。サイドバーと起動時の先読みで共通に使う)
+DEFAULT_RACE_NAME = 'Japanese Grand Prix'
+DEFAULT_SESSION_NAME = 'Race'
+
+def pick_default_race(race_names):
+    return DEFAULT_RACE_NAME if DEFAULT_RACE_NAME in race_names else race_names[0]
+
+def pick_default_session(session_names):
+    return DEFAULT_SESSION_NAME if DEFAULT_SESSION_NAME in session_names else session_names[-1]
+
 selected_year = st.sidebar.selectbox("Select Year:", supported_years)
 
 # (レーススケジュールの動的取得)
-@st.cache_data
+# (レース名 -> ラウンド番号の辞書も一緒に返し、再実行ごとの列比較を避ける)
+# 取得エラーは関数外で処理する (例外は st.cache_data に保存されないため、失敗結果がディスクに残らない)
+@st.cache_data(persist="disk", max_entries=SCHEDULE_CACHE_MAX_ENTRIES, show_spinner=False)
 def get_race_schedule(year):
-    try:
-        schedule = ff1.get_event_schedule(year, include_testing=False)
-        return schedule
-    except Exception as e:
-        st.sidebar.error(f"Error fetching {year} schedule: {e}")
-        return pd.DataFrame()
-
-schedule_df = get_race_schedule(selected_year)
+    schedule = ff1.get_event_schedule(year, include_testing=False)
+    name_to_round = dict(zip(schedule['OfficialEventName'], schedule['RoundNumber'].astype(int)))
+    return schedule[['RoundNumber', 'OfficialEventName', *SESSION_KEYS]], name_to_round
+
+try:
+    schedule_df, name_to_round = get_race_schedule(selected_year)
+except Exception as e:
+    st.sidebar.error(f"Error fetching {selected_year} schedule: {e}")
+    schedule_df, name_to_round = pd.DataFrame(), {}
 if schedule_df.empty:
     st.sidebar.error(f"{selected_year}年のレースデータが見つかりません。")
     selected_race = None
     selected_round = None
 else:
     race_names_list = schedule_df['OfficialEventName'].tolist()
-    default_race_name = 'Japanese Grand Prix' if 'Japanese Grand Prix' in race_names_list else race_names_list[0]
+    default_race_name = pick_default_race(race_names_list)
     selected_race = st.sidebar.selectbox("Select Race:", race_names_list, index=race_names_list.index(default_race_name))
-    selected_round = schedule_df.loc[schedule_df['OfficialEventName'] == selected_race, 'RoundNumber'].iloc[0]
+    selected_round = name_to_round[selected_race]
 
 # (セッションの動的取得)
-@st.cache_data
+@st.cache_data(persist="disk", max_entries=SCHEDULE_CACHE_MAX_ENTRIES, show_spinner=False)
 def get_event_sessions(year, round_number):
     if round_number is None: return []
     try: rn_int = int(round_number)
     except (ValueError, TypeError): return []
-    try:
-        event = ff1.get_event(year, rn_int) 
-        session_keys = ['Session1', 'Session2', 'Session3', 'Session4', 'Session5']
-        sessions_from_event = [event[key] for key in session_keys if event[key]]
-        session_order = {'Practice 1': 1, 'Practice 2': 2, 'Practice 3': 3, 'Sprint Shootout': 4, 'Sprint Qualifying': 4.5, 'Qualifying': 5, 'Sprint': 6, 'Race': 7, 'FP1': 1, 'FP2': 2, 'FP3': 3, 'SQ': 4, 'Q': 5, 'S': 6, 'R': 7}
-        sessions_sorted = sorted([s for s in sessions_from_event if s in session_order], key=lambda s: session_order[s])
-        return sessions_sorted
-    except Exception as e:
-        st.sidebar.warning(f"セッション取得エラー (Y: {year}, R: {rn_int}): {e}")
-        return []
-
-session_names_list = get_event_sessions(selected_year, selected_round)
+    # スケジュール (キャッシュ済み) の該当ラウンド行から Session1-5 を読む (FastF1 への再問い合わせなし)
+    schedule, _ = get_race_schedule(year)
+    event = schedule.loc[schedule['RoundNumber'] == rn_int].iloc[0]
+    sessions_from_event = [event[key] for key in SESSION_KEYS if event[key]]
+    event_sessions = set(sessions_from_event)
+    sessions_sorted = [s for s in SESSION_ORDER if s in event_sessions]
+    return sessions_sorted
+
+try:
+    session_names_list = get_event_sessions(selected_year, selected_round)
+except Exception as e:
+    st.sidebar.warning(f"セッション取得エラー (Y: {selected_year}, R: {selected_round}): {e}")
+    session_names_list = []
 if not session_names_list:
     st.sidebar.warning("このGPのセッション情報が見つかりません。")
     selected_session = None
 else:
-    default_session = 'Race' if 'Race' in session_names_list else session_names_list[-1]
-    selected_session = st.sidebar.selectbox("Select Session:", session_names_list, index=list(session_names_list).index(default_session) if default_session in session_names_list else 0)
+    default_session = pick_default_session(session_names_list)
+    selected_session = st.sidebar.selectbox("Select Session:", session_names_list, index=session_names_list.index(default_session))
 
 # (データ取得)
-@st.cache_data
+# laps / results のうちアプリで実際に使う列のみをキャッシュする
+# (IsPersonalBest は pick_fastest、IsAccurate は pick_accurate が参照)
+LAPS_COLUMNS = (
+    'Driver', 'LapNumber', 'LapTime', 'Sector1Time', 'Sector2Time', 'Sector3Time',
+    'Stint', 'Compound', 'TyreLife', 'PitInTime', 'PitOutTime', 'TrackStatus', 'IsAccurate', 'IsPersonalBest'
+)
+RESULTS_COLUMNS = ('Abbreviation', 'TeamName', 'TeamColor', 'Q1', 'Q2', 'Q3')
+CATEGORY_COLUMNS = ('Driver', 'Compound', 'TeamName', 'Abbreviation')
+
+# Session 本体は cache_resource で1つだけ保持 (戻り値のハッシュ/pickle を行わない)
+# (先読みスレッドからも呼ばれるため、スピナーは呼び出し側で表示する)
+@st.cache_resource(max_entries=SESSION_OBJ_CACHE_MAX_ENTRIES, show_spinner=False)
+def get_session_obj(year, race_name, session_name):
+    # キャッシュ済みスケジュールのラウンド番号で指定し、FastF1 側のイベント名のあいまい検索を省く
+    _, name_to_round = get_race_schedule(year)
+    session = ff1.get_session(year, name_to_round.get(race_name, race_name), session_name)
+    session.load(**SESSION_LOAD_KWARGS)
+    return session
+
+# --- 既定表示のセッションを別スレッドで先読み (初回表示のダウンロード待ちを減らす) ---
+# サイドバーと同じ既定値 (先頭の年・既定レース・既定セッション) で get_session_obj を呼ぶため表示側と同じキャッシュキーになり、
+# 同時に呼ばれても Streamlit がキーごとに計算を1回にまとめる (FastF1 のダウンロードが二重にならない)
+def _prewarm_default_session():
+    year = supported_years[0]
+    try:
+        schedule, year_name_to_round = get_race_schedule(year)
+        race_name = pick_default_race(schedule['OfficialEventName'].tolist())
+        session_name = pick_default_session(get_event_sessions(year, year_name_to_round[race_name]))
+        get_session_obj(year, race_name, session_name)
+    except Exception:
+        logger.warning("Prewarming the default %s session failed", year, exc_info=True)
+
+# cache_resource によりプロセスごとに1回だけスレッドを起動
+@st.cache_resource(show_spinner=False)
+def start_prewarm():
+    thread = threading.Thread(target=_prewarm_default_session, name='prewarm-default-session', daemon=True)
+    thread.start()
+    return thread
+
+start_prewarm()
+
+# laps/results も cache_resource で参照を保持 (ヒット時の unpickle/コピーを省く)
+# 返り値は全タブで共有されるため、呼び出し側では変更しないこと
+@st.cache_resource(max_entries=SESSION_CACHE_MAX_ENTRIES, show_spinner=False)
 def load_session_data(year, race_name, session_name):
-    if not all([year, race_name, session_name]): return None, None
+    if year is None or race_name is None or session_name is None: return None, None
     try:
-        session = ff1.get_session(year, race_name, session_name)
-        session.load()
-        return session.laps, session.results
+        session = get_session_obj(year, race_name, session_name)
+        laps_cols = [c for c in LAPS_COLUMNS if c in session.laps.columns]
+        results_cols = [c for c in RESULTS_COLUMNS if c in session.results.columns]
+        # 射影した Laps の .session を外し、Session 本体を参照し続けないようにする
+        # (Session の保持数を get_session_obj の上限だけで決めるため。pick_fastest/pick_accurate は .session を使わない)
+        laps = session.laps[laps_cols]
+        laps.session = None
+        results = pd.DataFrame(session.results[results_cols]).reset_index(drop=True)
+        # 低カーディナリティの文字列列は category 型に (比較・groupby が整数コードで済む)
+        for df in (laps, results):
+            for c in CATEGORY_COLUMNS:
+                if c in df.columns: df[c] = df[c].astype('category')
+        # LapTimeSeconds もここで一度だけ計算 (各タブ・再実行ごとの変換を避ける)
+        # timedelta64[ns] の int64 バッファを直接秒に変換 (NaT は NaN に)
+        lap_ns = laps['LapTime'].to_numpy(dtype='timedelta64[ns]').view('int64')
+        laps['LapTimeSeconds'] = np.where(laps['LapTime'].notna().to_numpy(), lap_ns * 1e-9, np.nan).astype('float32')
+        # LapNumber (<~80) / TyreLife (<~50) は float32 で十分。FastF1 では NaN を含み得るため整数型にはしない
+        laps['LapNumber'] = laps['LapNumber'].astype('float32')
+        laps['TyreLife'] = laps['TyreLife'].astype('float32')
+        return laps, results
     except Exception as e:
         st.error(f"データ取得エラー: {year} {race_name} '{session_name}' - {e}")
         return None, None
 
-# --- メイン処理 ---
-laps, results = load_session_data(selected_year, selected_race, selected_session)
-
+# (pick_accurate の結果をセッションごとに1回だけ計算し、各タブで共有)
+# 利用側は列の選択のみのため、.session を持たない素の DataFrame にしてからキャッシュする
+@st.cache_data(max_entries=SESSION_CACHE_MAX_ENTRIES)
+def get_clean_laps(year, race_name, session_name):
+    laps, _ = load_session_data(year, race_name, session_name)
+    if laps is None: return None
+    laps_cleaned = pd.DataFrame(laps.pick_accurate())
+    # 整数値のみの列は int8/int16 に (NaN を含む列は float32 のまま)
+    for c in ('LapNumber', 'TyreLife', 'Stint'):
+        laps_cleaned[c] = pd.to_numeric(laps_cleaned[c], downcast='integer')
+    return laps_cleaned
+
+# (ドライバー別のクリーンラップ。ドライバー切替時の再フィルタを避ける)
+# (Laps は .session を保持し pickle に Session 全体が含まれるため、素の DataFrame で返す)
+@st.cache_data(max_entries=DRIVER_CACHE_MAX_ENTRIES)
+def get_driver_accurate_laps(year, race_name, session_name, driver):
+    laps_cleaned = get_clean_laps(year, race_name, session_name)
+    if laps_cleaned is None: return pd.DataFrame()
+    # pick_driver (全列の Laps を作る) を経由せず、行マスクと必要列を1回の .loc で切り出す
+    return pd.DataFrame(laps_cleaned.loc[
+        laps_cleaned['Driver'] == driver, ['LapNumber', 'LapTimeSeconds', 'Compound', 'Stint', 'TyreLife']
+    ]).reset_index(drop=True)
+
+# (スティント集計。Driver は結果順の逆順カテゴリとして保持し、Plotly の軸順に使う)
+@st.cache_data(max_entries=SESSION_CACHE_MAX_ENTRIES)
+def stint_table(year, race_name, session_name):
+    laps, results = load_session_data(year, race_name, session_name)
+    # 必要な4列だけに絞り、周回数/スティント番号は小さい整数型にしてから集計
+    sub = laps[['Driver', 'Stint', 'LapNumber', 'Compound']].dropna(subset=['Stint', 'LapNumber'])
+    sub = sub.astype({'LapNumber': 'int16', 'Stint': 'int8'})
+    stints = sub.groupby(['Driver', 'Stint'], observed=True, sort=False).agg(
+        Lap_Start=('LapNumber', 'min'), Lap_End=('LapNumber', 'max'), Compound=('Compound', 'first')
+    ).reset_index()
+    stints['Stint_Length'] = stints.eval('Lap_End - Lap_Start + 1').astype('int16')
+    stints['Driver'] = pd.Categorical(
+        stints['Driver'], categories=list(reversed(results['Abbreviation'].tolist())), ordered=True
+    )
+    return stints
+
+# (H2H 比較用のマージ済みフレーム。ドライバーの組ごとにキャッシュ)
+@st.cache_data(max_entries=DRIVER_CACHE_MAX_ENTRIES)
+def h2h_frame(year, race_name, session_name, driver1, driver2):
+    # LapNumber をインデックスにした2本の Series を内部結合 (両者が走った周のみ残す)
+    laps_cleaned = get_clean_laps(year, race_name, session_name)
+    lap_times = laps_cleaned[['LapNumber', 'Driver', 'LapTimeSeconds']].set_index('LapNumber')
+    wide = pd.concat(
+        [lap_times.loc[lap_times['Driver'] == d, 'LapTimeSeconds'] for d in (driver1, driver2)],
+        axis=1, join='inner', keys=[driver1, driver2]
+    ).dropna()
+    wide['Delta'] = wide[driver1] - wide[driver2]
+    return wide.reset_index()
+
+# (クリーンラップを持つドライバーのソート済み一覧と、略称 -> インデックスの辞書)
+@st.cache_data(max_entries=SESSION_CACHE_MAX_ENTRIES)
+def get_sorted_drivers(year, race_name, session_name):
+    laps_cleaned = get_clean_laps(year, race_name, session_name)
+    if laps_cleaned is None: return (), {}
+    drivers = tuple(sorted(laps_cleaned['Driver'].unique().tolist()))
+    return drivers, {d: i for i, d in enumerate(drivers)}
 
-# --- Deg 分析のためのヘルパー関数 (変更なし) ---
-def calculate_advanced_deg(laps_df, results_df):
-    from sklearn.linear_model import LinearRegression
+# --- メイン処理 ---
+with st.spinner("セッションデータを読み込み中..."):
+    laps, results = load_session_data(selected_year, selected_race, selected_session)
+
+
+# --- Deg 分析のためのヘルパー関数 ---
+def _deg_group_stats(group_id, n_groups, x, y):
+    # グループIDごとに n, Σx, Σy, Σx², Σxy を1パスで集計 (pandas の groupby を経由しない)
+    return np.stack([
+        np.bincount(group_id, minlength=n_groups).astype('f8'),
+        np.bincount(group_id, weights=x, minlength=n_groups),
+        np.bincount(group_id, weights=y, minlength=n_groups),
+        np.bincount(group_id, weights=x * x, minlength=n_groups),
+        np.bincount(group_id, weights=x * y, minlength=n_groups),
+    ])
+
+def _calculate_advanced_deg_impl(laps_df, results_df):
     STARTING_FUEL_KG = 110.0
     FUEL_BURN_RATE_KG_PER_LAP = 1.6
     FUEL_EFFECT_SEC_PER_KG = 0.03
     TRACK_EVO_EFFECT_SEC_PER_LAP = 0.01
 
-    laps_with_team = pd.merge(
-        laps_df, results_df[['Abbreviation', 'TeamName']], 
-        left_on='Driver', right_on='Abbreviation', how='left'
+    team_map = dict(zip(results_df['Abbreviation'], results_df['TeamName']))
+    clean_mask = np.logical_and.reduce([
+        laps_df['PitInTime'].isna().to_numpy(), laps_df['PitOutTime'].isna().to_numpy(),
+        laps_df['TrackStatus'].to_numpy() == '1', laps_df['LapNumber'].to_numpy() > 1,
+        laps_df['LapTime'].notna().to_numpy()
+    ])
+
+    # 燃料ペナルティ (STARTING_FUEL - lap*BURN)*EFFECT と路面進化 (lap-1)*EVO を
+    # lap の一次式にまとめ、中間列を作らずに補正後タイムだけを計算
+    lap = laps_df['LapNumber'].to_numpy(dtype='f8')[clean_mask]
+    corrected = (
+        laps_df['LapTimeSeconds'].to_numpy(dtype='f8')[clean_mask]
+        + lap * (FUEL_BURN_RATE_KG_PER_LAP * FUEL_EFFECT_SEC_PER_KG + TRACK_EVO_EFFECT_SEC_PER_LAP)
+        - (STARTING_FUEL_KG * FUEL_EFFECT_SEC_PER_KG + TRACK_EVO_EFFECT_SEC_PER_LAP)
     )
-    clean_laps = laps_with_team.loc[
-        (laps_with_team['PitInTime'].isna()) & (laps_with_team['PitOutTime'].isna()) & 
-        (laps_with_team['TrackStatus'] == '1') & (laps_with_team['LapNumber'] > 1)
-    ].dropna(subset=['LapTime']).copy()
-    
-    clean_laps['LapTimeSeconds'] = clean_laps['LapTime'].dt.total_seconds()
-    clean_laps['FuelLoad_KG'] = STARTING_FUEL_KG - (clean_laps['LapNumber'] * FUEL_BURN_RATE_KG_PER_LAP)
-    clean_laps['FuelPenalty_sec'] = clean_laps['FuelLoad_KG'] * FUEL_EFFECT_SEC_PER_KG
-    clean_laps['TrackEvo_Gain_sec'] = (clean_laps['LapNumber'] - 1) * TRACK_EVO_EFFECT_SEC_PER_LAP
-    clean_laps['FullyCorrected_LapTimeSeconds'] = (
-        clean_laps['LapTimeSeconds'] - clean_laps['FuelPenalty_sec'] + clean_laps['TrackEvo_Gain_sec']
+
+    # 回帰に必要な列だけでクリーンラップを構築 (dropna は1回のみ)
+    reg_laps = pd.DataFrame({
+        'TeamName': laps_df['Driver'].map(team_map).to_numpy()[clean_mask],
+        'Compound': laps_df['Compound'].to_numpy()[clean_mask],
+        'TyreLife': laps_df['TyreLife'].to_numpy(dtype='f8')[clean_mask],
+        'FullyCorrected_LapTimeSeconds': corrected
+    }).dropna()
+
+    # (チーム, コンパウンド) ごとの傾きを閉形式 cov(x,y)/var(x) で一括計算
+    team_id, teams = pd.factorize(reg_laps['TeamName'])
+    comp_id, compounds = pd.factorize(reg_laps['Compound'])
+    n, sx, sy, sxx, sxy = _deg_group_stats(
+        team_id * len(compounds) + comp_id, len(teams) * len(compounds),
+        reg_laps['TyreLife'].to_numpy(), reg_laps['FullyCorrected_LapTimeSeconds'].to_numpy()
     )
-    
-    deg_data: List[Any] = []
-    
-    for team in clean_laps['TeamName'].unique():
-        for compound in clean_laps['Compound'].unique():
-            subset = clean_laps.loc[(clean_laps['TeamName'] == team) & (clean_laps['Compound'] == compound)]
-            subset = subset.dropna(subset=['TyreLife', 'FullyCorrected_LapTimeSeconds'])
-            
-            if len(subset) > 10:
-                model = LinearRegression()
-                X = subset[['TyreLife']]; y = subset['FullyCorrected_LapTimeSeconds']
-                model.fit(X, y) 
-                deg_rate_sec_per_lap = model.coef_[0]
-                
-                deg_data.append({
-                    'TeamName': team, 'Compound': compound,
-                    'DegRate_sec_lap': deg_rate_sec_per_lap, 'LapsAnalyzed': len(subset)
-                })
-
-    deg_df = pd.DataFrame(deg_data)
-    compound_order = ['SOFT', 'MEDIUM', 'HARD', 'INTERMEDIATE', 'WET']
-    compound_dtype = pd.CategoricalDtype(categories=compound_order, ordered=True)
-    deg_df['Compound'] = deg_df['Compound'].astype(compound_dtype)
+    keep = np.flatnonzero(n > 10)
+
+    deg_df = pd.DataFrame({
+        'TeamName': teams[keep // len(compounds)], 'Compound': compounds[keep % len(compounds)],
+        'DegRate_sec_lap': (n * sxy - sx * sy)[keep] / (n * sxx - sx ** 2)[keep],
+        'LapsAnalyzed': n[keep].astype(int)
+    })
+    deg_df['Compound'] = deg_df['Compound'].astype(COMPOUND_DTYPE)
     deg_df = deg_df.sort_values(by=['TeamName', 'Compound'])
     
     return deg_df
 
+# (Laps はハッシュ不可のため、年/レース/セッションの組をキーにキャッシュ)
+@st.cache_data(max_entries=SESSION_CACHE_MAX_ENTRIES, show_spinner=False)
+def calculate_advanced_deg_cached(year, race_name, session_name):
+    laps_df, results_df = load_session_data(year, race_name, session_name)
+    if laps_df is None or results_df is None: return pd.DataFrame()
+    return _calculate_advanced_deg_impl(laps_df, results_df)
+
+# --- グラフ生成 (年/レース/セッション等のスカラーをキーにキャッシュ) ---
+# plotly の import は重いため、初回描画まで遅延させる
+# 図は描画に渡すだけの読み取り専用なので、すべて cache_resource で Figure の参照を保持
+# (cache_data だとヒットのたびに unpickle で Figure を再構築・検証することになる)
+WEBGL_POINT_THRESHOLD = 1000
+
+def _render_mode(n_points):
+    # 点数が多い場合のみ WebGL (scattergl) で描画。少数点はベクター (SVG) のまま
+    return 'webgl' if n_points > WEBGL_POINT_THRESHOLD else 'svg'
+
+@st.cache_resource(max_entries=DRIVER_CACHE_MAX_ENTRIES, show_spinner=False)
+def build_driver_fig(year, race_name, session_name, driver):
+    import plotly.express as px
+    driver_laps = get_driver_accurate_laps(year, race_name, session_name, driver)
+    fig = px.scatter(driver_laps, x='LapNumber', y='LapTimeSeconds', color='Compound',
+                     color_discrete_map=TYRE_COLORS, hover_data=['Stint', 'TyreLife'],
+                     render_mode=_render_mode(len(driver_laps)))
+    fig.update_layout(title=f"{driver} - Lap Times by Lap Number", xaxis_title="Lap Number", yaxis_title="Lap Time (Seconds)")
+    return fig
+
+@st.cache_resource(max_entries=SESSION_CACHE_MAX_ENTRIES, show_spinner=False)
+def build_deg_bar(year, race_name, session_name):
+    import plotly.express as px
+    deg_df = calculate_advanced_deg_cached(year, race_name, session_name)
+    return px.bar(
+        deg_df[['TeamName', 'Compound', 'DegRate_sec_lap']], x='TeamName', y='DegRate_sec_lap', color='Compound', barmode='group',
+        color_discrete_map=TYRE_COLORS, category_orders={'Compound': list(COMPOUND_ORDER)},
+        title=f"{race_name} - Calculated Tyre Degradation Rate",
+        labels={'DegRate_sec_lap': 'Degradation Rate (seconds per lap)', 'TeamName': 'Team'}
+    )
+
+@st.cache_resource(max_entries=SESSION_CACHE_MAX_ENTRIES, show_spinner=False)
+def build_stint_timeline(year, race_name, session_name):
+    import plotly.express as px
+    stints_df = stint_table(year, race_name, session_name)
+    fig = px.bar(
+        stints_df, base="Lap_Start", x="Stint_Length", y="Driver", color="Compound",
+        color_discrete_map=TYRE_COLORS, orientation='h', hover_data=['Stint', 'Lap_Start', 'Lap_End']
+    )
+    fig.update_yaxes(categoryorder='array', categoryarray=list(stints_df['Driver'].cat.categories))
+    fig.update_layout(title=f"{race_name} - Race Pit Stop Strategy", xaxis_title="Lap Number")
+    return fig
+
+@st.cache_resource(max_entries=DRIVER_CACHE_MAX_ENTRIES, show_spinner=False)
+def build_h2h_figs(year, race_name, session_name, driver1, driver2):
+    import plotly.graph_objects as go
+    h2h_data = h2h_frame(year, race_name, session_name, driver1, driver2)
+    # melt + px.line を経由せず、ドライバーごとの配列から直接トレースを作る
+    trace_cls = go.Scattergl if _render_mode(2 * len(h2h_data)) == 'webgl' else go.Scatter
+    lap_numbers = h2h_data['LapNumber'].to_numpy()
+    fig_laps = go.Figure([
+        trace_cls(x=lap_numbers, y=h2h_data[driver].to_numpy(), mode='lines', name=driver)
+        for driver in (driver1, driver2)
+    ])
+    fig_laps.update_layout(title=f"Lap Times: {driver1} vs {driver2}", xaxis_title="LapNumber", yaxis_title="LapTime", legend_title_text="Driver")
+    fig_delta = go.Figure(go.Scatter(
+        x=lap_numbers, y=h2h_data['Delta'].to_numpy(dtype='float32'), mode='lines', fill='tozeroy', name='Delta'
+    ))
+    fig_delta.update_layout(title=f"Delta: {driver1} (Time) - {driver2} (Time)", xaxis_title="LapNumber", yaxis_title="Delta")
+    fig_delta.add_hline(y=0, line_dash="dash", line_color="black")
+    return fig_laps, fig_delta
+
 # --- タブの定義 ---
+# 各タブの本体は st.fragment とし、タブ内のウィジェット操作ではそのタブだけを再実行する
+# (フラグメントからはサイドバーに書き込めないため、ドライバー選択は各タブ内に配置)
 tab1, tab2, tab3, tab4 = st.tabs([
     "📊 Session Analysis (セッション分析)", 
     "📈 Advanced Degradation (高度な劣化分析)",
@@ -150,7 +404,8 @@ tab1, tab2, tab3, tab4 = st.tabs([
 
 
 # --- タブ1 (セッション分析) ---
-with tab1:
+@st.fragment
+def render_tab1(laps, results, selected_year, selected_race, selected_session):
     st.header(f"{selected_year} {selected_race} - {selected_session}")
     if laps is None or laps.empty:
         st.info("サイドバーで分析したい「年」「レース」「セッション」を選択してください。")
@@ -161,28 +416,27 @@ with tab1:
     elif selected_session in ['Qualifying', 'Sprint Shootout', 'Q', 'SQ', 'Practice 1', 'Practice 2', 'Practice 3', 'FP1', 'FP2', 'FP3']:
         st.info(f"{selected_session}セッションです。全ドライバーの最速ラップを表示します。")
         try:
-            # 1. データの整形とTimedeltaの文字列化
-            quali_laps = laps.copy()
-            quali_results = results.copy()
+            # 1. データの整形とTimedeltaの文字列化 (Copy-on-Write のため元データのコピーは不要)
+            quali_results = results
             
-            # タイムフォーマット関数 (Timedelta -> 'MM:SS.mmm' or 'SS.mmm')
-            def format_time(td: pd.Timedelta) -> str:
-                if pd.isna(td): return ""
-                total_seconds=td.total_seconds()
-                minutes=int(total_seconds//60)
-                seconds = int(total_seconds % 60)
-                milliseconds = int((total_seconds - int(total_seconds)) * 1000)
-                if total_seconds >= 60:
-                     return f"{minutes:02}:{seconds:02}.{milliseconds:03}"
-                else:
-                     return f"{seconds:02}.{milliseconds:03}"
+            # タイムフォーマット関数 (Timedelta列 -> 'MM:SS.mmm' or 'SS.mmm' の文字列列)
+            # ナノ秒の int64 を整数演算で分解し、列全体を一括で整形する
+            def format_time(td: pd.Series) -> pd.Series:
+                total_ms = td.to_numpy(dtype='timedelta64[ns]').view('int64') // 1_000_000
+                minutes = pd.Series(total_ms // 60_000).astype(str).str.zfill(2)
+                seconds = pd.Series((total_ms // 1000) % 60).astype(str).str.zfill(2)
+                milliseconds = pd.Series(total_ms % 1000).astype(str).str.zfill(3)
+                sec_str = seconds + '.' + milliseconds
+                formatted = np.where(total_ms >= 60_000, minutes + ':' + sec_str, sec_str)
+                formatted[td.isna().to_numpy()] = ""
+                return pd.Series(formatted, index=td.index)
 
             # 2. lapsのTimedeltaを全て文字列に変換 (ハイライトのため)
             # ※この変換は、後のハイライト関数（文字列比較）に必要な処理です
-            quali_laps_str = quali_laps.copy()
-            for col in ["LapTime", "Sector1Time", "Sector2Time", "Sector3Time"]:
-                 if col in quali_laps_str.columns:
-                      quali_laps_str[col] = quali_laps_str[col].apply(format_time)
+            quali_laps_str = laps.assign(**{
+                col: format_time(laps[col])
+                for col in ["LapTime", "Sector1Time", "Sector2Time", "Sector3Time"] if col in laps.columns
+            })
 
             
             # 3. resultsのTimedeltaを全て文字列に変換
@@ -191,28 +445,20 @@ with tab1:
                 st.error("エラー: Q1/Q2/Q3の公式タイムが見つかりません。")
                 st.stop()
                  
-            # 4. Qxベストタイムの文字列リストを作成 (ハイライト比較用)
-            def create_formatted_time_list(col: str) -> List[str]:
-                 # タイムをフォーマットし、NaNや空文字列を除外
-                 return [format_time(td) for td in quali_results[col].dropna() if pd.notna(td)]
-
-            q1_laptimes = create_formatted_time_list('Q1')
-            q2_laptimes = create_formatted_time_list('Q2')
-            q3_laptimes = create_formatted_time_list('Q3')
-            
-            
-            # 5. ハイライト関数 (文字列比較)
+            # 4. Qxベストタイムの文字列 -> 色の辞書を作成 (ハイライト比較用)
+            # Q3 > Q2 > Q1 の優先度になるよう、Q1 -> Q2 -> Q3 の順に上書き
+            highlight_colors = {}
+            for seg, color in (('Q1', '#d0f0c0'), ('Q2', '#add8e6'), ('Q3', '#ffc0cb')):
+                q_times = format_time(quali_results[seg].dropna())
+                highlight_colors.update(dict.fromkeys(q_times[q_times != ""], color))
+
+            # 5. ハイライト関数 (辞書を1回引くだけ)
             def highlight_q1_q2_q3(row: pd.Series) -> List[str]:
                 # row は既に文字列化されたデータを持つ (LapTime, Sector1Time...を含む)
-                # Q3 > Q2 > Q1 の優先度
-                if row["LapTime"] in q3_laptimes:
-                    return ['background-color: #ffc0cb; color: black'] * len(row)
-                elif row["LapTime"] in q2_laptimes:
-                    return ['background-color: #add8e6; color: black'] * len(row)
-                elif row["LapTime"] in q1_laptimes:
-                    return ['background-color: #d0f0c0; color: black'] * len(row)
-                else:
-                    return [''] * len(row)
+                color = highlight_colors.get(row["LapTime"])
+                if color:
+                    return [f'background-color: {color}; color: black'] * len(row)
+                return [''] * len(row)
 
             # 6. 表示用DataFrameの作成 (全ドライバーの最速ラップ)
             fastest_laps = laps.pick_fastest()
@@ -227,6 +473,11 @@ with tab1:
                 st.warning("最速ラップデータが見つかりませんでした。")
                 st.stop()
 
+            # LapTime (Timedelta) の argsort で先に並べ替える (マージは左側の順序を保つため、文字列化後の再ソートは不要)
+            fastest_laps_df = fastest_laps_df.iloc[
+                np.argsort(fastest_laps_df['LapTime'].to_numpy(dtype='timedelta64[ns]'), kind='stable')
+            ]
+
             # ★★★ 修正点2: 表示用DFに文字列化されたLapTimeを紐付ける ★★★
             # (fastest_laps_dfはTimedelta型、quali_laps_strは文字列型)
             
@@ -245,8 +496,8 @@ with tab1:
                 left_on='Driver', right_on='Abbreviation', how='left'
             ).drop(columns=['Abbreviation']).rename(columns={'Driver': 'Abbreviation'})
 
-            # 最終的な表示DFの列を選択し、LapTimeでソート
-            display_df = display_df.rename(columns={'Driver': 'Abbreviation'}).sort_values(by='LapTime').reset_index(drop=True)
+            # 最終的な表示DF (並びは argsort 済みの fastest_laps_df の順)
+            display_df = display_df.reset_index(drop=True)
 
 
             # 7. スタイル適用
@@ -265,28 +516,27 @@ with tab1:
     elif selected_session in ['Race', 'Sprint', 'S', 'R']:
         driver_laps_final = pd.DataFrame() # NameError対策
         st.info("決勝/スプリントセッションです。ドライバーのラップタイムを分析します。")
-        laps_cleaned = laps.pick_accurate() 
-        if laps_cleaned.empty:
+        drivers, drivers_idx = get_sorted_drivers(selected_year, selected_race, selected_session)
+        if not drivers:
             st.warning("分析可能なクリーンラップデータがありません。")
         else:
-            laps_cleaned['LapTimeSeconds'] = laps_cleaned['LapTime'].dt.total_seconds()
-            drivers = laps_cleaned['Driver'].unique(); drivers.sort()
-            default_driver = 'TSU' if 'TSU' in drivers else drivers[0]
-            selected_driver = st.sidebar.selectbox("Select Driver (for Tab 1):", drivers, index=list(drivers).index(default_driver))
+            selected_driver = st.selectbox("Select Driver:", drivers, index=drivers_idx.get('TSU', 0))
             st.subheader(f"{selected_driver} Lap Time Analysis")
             
-            driver_laps_final = laps_cleaned.pick_driver(selected_driver)
+            driver_laps_final = get_driver_accurate_laps(selected_year, selected_race, selected_session, selected_driver)
             
             if not driver_laps_final.empty:
-                fig_driver = px.scatter(driver_laps_final, x='LapNumber', y='LapTimeSeconds', color='Compound',
-                                     color_discrete_map=TYRE_COLORS, hover_data=['Stint', 'TyreLife'])
-                fig_driver.update_layout(title=f"{selected_driver} - Lap Times by Lap Number", xaxis_title="Lap Number", yaxis_title="Lap Time (Seconds)")
+                fig_driver = build_driver_fig(selected_year, selected_race, selected_session, selected_driver)
                 st.plotly_chart(fig_driver, use_container_width=True)
             else: st.warning(f"選択された {selected_driver} のラップデータが見つかりませんでした。")
 
+with tab1:
+    render_tab1(laps, results, selected_year, selected_race, selected_session)
+
 
 # --- タブ2 (高度な劣化分析) ---
-with tab2:
+@st.fragment
+def render_tab2(laps, results, selected_year, selected_race, selected_session):
     st.header("📈 Advanced Tyre Degradation Analysis")
     if laps is None or results is None or selected_session not in ['Race', 'Sprint', 'S', 'R']:
         st.info("この分析は、「決勝(Race)」または「スプリント(Sprint)」セッション選択時のみ利用可能です。")
@@ -295,22 +545,16 @@ with tab2:
         **F1ストラテジスト手法:** 燃料負荷と路面進化のバイアスを補正し、チーム/コンパウンドごとの**真のデグラデーション率**（1周あたり何秒遅くなるか）を線形回帰で計算します。
         """)
         
-        # キャッシュなしで直接呼び出し
+        # (year, race, session) をキーにしたキャッシュ版を呼び出し
         if st.button("Run Advanced Degradation Analysis"):
             with st.spinner("高度な補正と回帰モデルを実行中..."):
                 try:
-                    deg_df = calculate_advanced_deg(laps, results)
+                    deg_df = calculate_advanced_deg_cached(selected_year, selected_race, selected_session)
                     
                     if deg_df.empty:
                          st.warning("分析に必要な最低周回数（10周）を満たすクリーンラップがありませんでした。")
                     else:
-                        compound_order = ['SOFT', 'MEDIUM', 'HARD', 'INTERMEDIATE', 'WET']
-                        fig_deg_bar = px.bar(
-                            deg_df, x='TeamName', y='DegRate_sec_lap', color='Compound', barmode='group',
-                            color_discrete_map=TYRE_COLORS, category_orders={'Compound': compound_order},
-                            title=f"{selected_race} - Calculated Tyre Degradation Rate",
-                            labels={'DegRate_sec_lap': 'Degradation Rate (seconds per lap)', 'TeamName': 'Team'}
-                        )
+                        fig_deg_bar = build_deg_bar(selected_year, selected_race, selected_session)
                         st.plotly_chart(fig_deg_bar, use_container_width=True)
                         st.subheader("Raw Data")
                         st.dataframe(deg_df.round(4).set_index(['TeamName', 'Compound']))
@@ -318,70 +562,59 @@ with tab2:
                     st.error(f"分析の実行中にエラーが発生しました: {e}")
                     st.error("Trace: " + str(e))
 
+with tab2:
+    render_tab2(laps, results, selected_year, selected_race, selected_session)
+
 
 # --- タブ3 (ピット戦略) ---
-with tab3:
+@st.fragment
+def render_tab3(laps, results, selected_year, selected_race, selected_session):
     st.header("🗺️ Pit Strategy Timeline (Gantt Chart)")
     if laps is None or results is None or selected_session not in ['Race', 'Sprint', 'S', 'R']:
         st.info("この分析は、「決勝(Race)」または「スプリント(Sprint)」セッション選択時のみ利用可能です。")
     else:
         try:
-            stints_df = laps.groupby(['Driver', 'Stint']).agg(
-                Lap_Start=('LapNumber', 'min'), Lap_End=('LapNumber', 'max'), Compound=('Compound', 'first')    
-            ).reset_index()
-            stints_df['Stint_Length'] = stints_df['Lap_End'] - stints_df['Lap_Start'] + 1
-            drivers_list_sorted = results['Abbreviation'].tolist() 
-            fig_timeline = px.bar(
-                stints_df, base="Lap_Start", x="Stint_Length", y="Driver", color="Compound",       
-                color_discrete_map=TYRE_COLORS, orientation='h', hover_data=['Stint', 'Lap_Start', 'Lap_End']
-            )
-            fig_timeline.update_yaxes(categoryorder='array', categoryarray=list(reversed(drivers_list_sorted)))
-            fig_timeline.update_layout(title=f"{selected_race} - Race Pit Stop Strategy", xaxis_title="Lap Number")
+            fig_timeline = build_stint_timeline(selected_year, selected_race, selected_session)
             st.plotly_chart(fig_timeline, use_container_width=True)
         except Exception as e:
             st.error(f"ガントチャートの描画中にエラーが発生しました: {e}")
 
+with tab3:
+    render_tab3(laps, results, selected_year, selected_race, selected_session)
+
 
 # --- タブ4 (H2H ペース比較) ---
-with tab4:
+@st.fragment
+def render_tab4(laps, results, selected_year, selected_race, selected_session):
     st.header("⚔️ Head-to-Head (H2H) Pace Comparison")
     
     if laps is None or selected_session not in ['Race', 'Sprint', 'S', 'R']:
         st.info("この分析は、「決勝(Race)」または「スプリント(Sprint)」セッション選択時のみ利用可能です。")
     else:
-        laps_cleaned = laps.pick_accurate()
-        if laps_cleaned.empty:
+        drivers_list, drivers_idx = get_sorted_drivers(selected_year, selected_race, selected_session)
+        if not drivers_list:
             st.warning("比較対象のクリーンラップデータがありません。")
         else:
-            laps_cleaned['LapTimeSeconds'] = laps_cleaned['LapTime'].dt.total_seconds()
-            drivers_list = laps_cleaned['Driver'].unique(); drivers_list.sort()
             
-            st.sidebar.subheader("H2H Driver Selection (Tab 4)")
-            driver1_index = list(drivers_list).index('TSU') if 'TSU' in drivers_list else 0
-            driver1 = st.sidebar.selectbox("Select Driver 1:", drivers_list, index=driver1_index)
-            driver2_index = list(drivers_list).index('RIC') if 'RIC' in drivers_list and driver1 != 'RIC' else (driver1_index + 1) % len(drivers_list) if len(drivers_list) > 1 else 0
-            driver2 = st.sidebar.selectbox("Select Driver 2:", drivers_list, index=driver2_index)
+            st.subheader("H2H Driver Selection")
+            driver1_index = drivers_idx.get('TSU', 0)
+            driver1 = st.selectbox("Select Driver 1:", drivers_list, index=driver1_index)
+            driver2_index = drivers_idx['RIC'] if 'RIC' in drivers_idx and driver1 != 'RIC' else (driver1_index + 1) % len(drivers_list)
+            driver2 = st.selectbox("Select Driver 2:", drivers_list, index=driver2_index)
             
             if driver1 == driver2: st.warning("比較のために、異なる2人のドライバーを選択してください。")
             else:
-                laps_d1 = laps_cleaned.pick_driver(driver1)[['LapNumber', 'LapTimeSeconds']]
-                laps_d2 = laps_cleaned.pick_driver(driver2)[['LapNumber', 'LapTimeSeconds']]
-                h2h_data = pd.merge(laps_d1, laps_d2, on='LapNumber', suffixes=(f'_{driver1}', f'_{driver2}'))
+                h2h_data = h2h_frame(selected_year, selected_race, selected_session, driver1, driver2)
                 
                 if h2h_data.empty: st.warning(f"{driver1} と {driver2} の間に、比較可能なクリーンラップが1周もありませんでした。")
                 else:
-                    h2h_data['Delta'] = h2h_data[f'LapTimeSeconds_{driver1}'] - h2h_data[f'LapTimeSeconds_{driver2}']
                     st.subheader(f"Pace Comparison: {driver1} vs {driver2}")
-
-                    h2h_melted = h2h_data.melt(id_vars=['LapNumber'], value_vars=[f'LapTimeSeconds_{driver1}', f'LapTimeSeconds_{driver2}'], var_name='Driver', value_name='LapTime')
-                    h2h_melted['Driver'] = h2h_melted['Driver'].str.replace('LapTimeSeconds_', '')
-                    
-                    fig_h2h_laps = px.line(h2h_melted, x='LapNumber', y='LapTime', color='Driver', title=f"Lap Times: {driver1} vs {driver2}")
+                    fig_h2h_laps, fig_h2h_delta = build_h2h_figs(selected_year, selected_race, selected_session, driver1, driver2)
                     st.plotly_chart(fig_h2h_laps, use_container_width=True)
 
                     st.subheader(f"Time Delta per Lap ({driver1} vs {driver2})")
                     st.info(f"プラス ( > 0 ) の場合: {driver1} が {driver2} より遅い\n\nマイナス ( < 0 ) の場合: {driver1} が {driver2} より速い")
-                    
-                    fig_h2h_delta = px.area(h2h_data, x='LapNumber', y='Delta', title=f"Delta: {driver1} (Time) - {driver2} (Time)")
-                    fig_h2h_delta.add_hline(y=0, line_dash="dash", line_color="black")
-                    st.plotly_chart(fig_h2h_delta, use_container_width=True)
\ No newline at end of file
+                    st.plotly_chart(fig_h2h_delta, use_container_width=True)
+
+with tab4:
+    render_tab4(laps, results, selected_year, selected_race, selected_session)